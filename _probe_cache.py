@@ -0,0 +1,95 @@
+"""
+_probe_cache.py
+
+Small on-disk memo for ffprobe results, shared by script1.py and the
+inspect_*_profile.py scripts.
+
+A file is treated as unchanged while its (path, mtime, size) stay the same, so
+re-running a batch or inspecting a file again skips the ffprobe spawn.
+The cache lives in ~/.cache/mkv2mp4/probe.db (SQLite, WAL mode). If it can't be
+opened or written, probes simply run uncached.
+"""
+
+import functools
+import os
+import sqlite3
+import threading
+
+try:
+    from orjson import dumps as json_dumps, loads as json_loads  # faster, optional
+except ImportError:
+    import json
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+    json_loads = json.loads
+
+
+CACHE_PATH = os.path.expanduser("~/.cache/mkv2mp4/probe.db")
+
+_local = threading.local()
+
+
+def _connect():
+    """Return this thread's connection to the cache db, or None if unavailable."""
+    if not hasattr(_local, "conn"):
+        try:
+            os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+            conn = sqlite3.connect(CACHE_PATH)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS probe ("
+                " path TEXT, probe TEXT, mtime INTEGER, size INTEGER, json BLOB,"
+                " PRIMARY KEY (path, probe))"
+            )
+            conn.commit()
+        except (OSError, sqlite3.Error):
+            conn = None
+        _local.conn = conn
+    return _local.conn
+
+
+def cached_probe(func):
+    """Memoize ``func(path, *args)`` on (path, mtime, size).
+
+    The wrapped function's result must be JSON-serializable. Functions with
+    the same name and arguments share entries, so they must return the same
+    data for the same file.
+    """
+
+    @functools.wraps(func)
+    def wrapper(path, *args):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return func(path, *args)
+        conn = _connect()
+        if conn is None:
+            return func(path, *args)
+
+        key = os.path.abspath(path)
+        probe = func.__name__ + repr(args)
+        try:
+            row = conn.execute(
+                "SELECT json FROM probe WHERE path = ? AND probe = ? AND mtime = ? AND size = ?",
+                (key, probe, st.st_mtime_ns, st.st_size),
+            ).fetchone()
+            if row is not None:
+                return json_loads(row[0])
+        except sqlite3.Error:
+            pass
+
+        result = func(path, *args)
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO probe VALUES (?, ?, ?, ?, ?)",
+                (key, probe, st.st_mtime_ns, st.st_size, json_dumps(result)),
+            )
+            conn.commit()
+        except sqlite3.Error:
+            pass
+        return result
+
+    return wrapper
@@ -1,42 +1,409 @@
+import asyncio
+import glob
 import subprocess
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import tempfile
 
 INPUT_DIR = "Naruto_S6"
 OUTPUT_DIR = "Naruto_S6_"
-MAX_WORKERS = 4  # safe default
+LOG_DIR = os.path.join(OUTPUT_DIR, "logs")  # one ffmpeg log per job: <input name>.<job>.log
+VAAPI_DEVICE = "/dev/dri/renderD128"
+THREADS_PER_JOB = 2  # ffmpeg -threads per software encode
+# pin x264's own frame and lookahead threads too, so parallel jobs don't oversubscribe the CPU
+X264_PARAMS = f"threads={THREADS_PER_JOB}:sliced-threads=0:lookahead-threads=1"
+NVENC_SESSIONS = 6  # concurrent NVENC sessions
+MIN_SEGMENT_SECONDS = 120  # shorter files are encoded as a single job
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(LOG_DIR, exist_ok=True)
 
-def convert(file):
-    infile = os.path.join(INPUT_DIR, file)
-    outfile = os.path.join(OUTPUT_DIR, os.path.splitext(file)[0] + ".mp4")
+def ffmpeg_list(flag):
+    """Return the output of `ffmpeg -hide_banner <flag>`, or "" if ffmpeg can't run."""
+    try:
+        proc = subprocess.run(
+            ["ffmpeg", "-hide_banner", flag],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+        )
+    except OSError:
+        return ""
+    return proc.stdout
 
+# one-frame trial encode per hardware encoder through the same on-device filter chain
+# build_cmd() uses; build flags alone don't prove a usable device or filter
+TRIAL_ARGS = {
+    "nvenc": ["-vf", "hwupload_cuda,scale_cuda=1280:720:format=yuv420p", "-c:v", "h264_nvenc"],
+    "qsv": ["-vf", "format=nv12,hwupload=extra_hw_frames=64,vpp_qsv=w=1280:h=720:format=nv12",
+            "-c:v", "h264_qsv"],
+    "vaapi": ["-vf", "format=nv12,hwupload,scale_vaapi=1280:720:format=nv12", "-c:v", "h264_vaapi"],
+}
+# global options (device setup) that have to come before the input
+TRIAL_DEVICE_ARGS = {
+    "nvenc": ["-init_hw_device", "cuda"],
+    "qsv": ["-init_hw_device", "qsv=hw", "-filter_hw_device", "hw"],
+    "vaapi": ["-vaapi_device", VAAPI_DEVICE],
+}
+
+def encoder_works(encoder_kind):
+    """Return True if a one-frame test encode with the given hardware encoder succeeds."""
+    cmd = [
+        "ffmpeg", "-hide_banner", "-v", "error",
+        *TRIAL_DEVICE_ARGS.get(encoder_kind, []),
+        "-f", "lavfi", "-i", "color=s=256x256",
+        "-frames:v", "1",
+        *TRIAL_ARGS[encoder_kind],
+        "-f", "null", "-",
+    ]
+    try:
+        proc = subprocess.run(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            timeout=60,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return proc.returncode == 0
+
+def detect_encoder(encoders):
+    """Pick the fastest working encoder: nvenc -> qsv -> vaapi -> libx264."""
+    hwaccels = ffmpeg_list("-hwaccels").split()
+    if "h264_nvenc" in encoders and "cuda" in hwaccels and encoder_works("nvenc"):
+        return "nvenc"
+    if "h264_qsv" in encoders and "qsv" in hwaccels and encoder_works("qsv"):
+        return "qsv"
+    if ("h264_vaapi" in encoders and "vaapi" in hwaccels and os.path.exists(VAAPI_DEVICE)
+            and encoder_works("vaapi")):
+        return "vaapi"
+    return "libx264"
+
+def detect_audio_encoder(encoders):
+    """Pick the fastest AAC encoder: libfdk_aac -> aac_at (macOS) -> native aac."""
+    for name in ("libfdk_aac", "aac_at"):
+        if name in encoders:
+            return name
+    return "aac"
+
+def pick_workers(encoder_kind):
+    """How many ffmpeg jobs to run at once for the given encoder."""
+    if encoder_kind == "nvenc":
+        # bounded by the GPU's session limit, not by CPU cores
+        return NVENC_SESSIONS
+    if encoder_kind in ("qsv", "vaapi"):
+        return 4
+    # each libx264 job is pinned to THREADS_PER_JOB threads
+    return max(1, (os.cpu_count() or 1) // THREADS_PER_JOB)
+
+# probe once at startup
+FFMPEG_ENCODERS = ffmpeg_list("-encoders").split()
+ENCODER = detect_encoder(FFMPEG_ENCODERS)
+AUDIO_ENCODER = detect_audio_encoder(FFMPEG_ENCODERS)
+MAX_WORKERS = pick_workers(ENCODER)
+
+# 32 kHz matches the reference profile the TV plays (mp4_required_format.txt)
+AUDIO_ARGS = ["-c:a", AUDIO_ENCODER, "-b:a", "128k", "-ac", "2", "-ar", "32000"]
+
+def log_prefix(infile):
+    return os.path.join(LOG_DIR, os.path.splitext(os.path.basename(infile))[0])
+
+def clear_logs(infile):
+    """Remove logs left by an earlier run on this input (segment counts can differ)."""
+    prefix = glob.escape(log_prefix(infile))
+    for job in ("encode", "fallback", "audio", "concat", "seg[0-9][0-9][0-9][0-9]"):
+        for log in glob.glob(f"{prefix}.{job}.log"):
+            try:
+                os.remove(log)
+            except OSError:
+                pass
+
+async def run_ffmpeg(cmd, infile, job, check=False):
+    """Run ffmpeg with its stderr written to LOG_DIR/<input name>.<job>.log; return the exit code.
+
+    stdin is closed so parallel jobs never read (or fight over) the tty.
+    """
+    with open(f"{log_prefix(infile)}.{job}.log", "wb") as fh:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=fh,
+        )
+        returncode = await proc.wait()
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return returncode
+
+async def run_ffprobe(*args):
+    """Run ffprobe with the given arguments and return its stdout as text."""
+    proc = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error", *args,
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+    stdout, _ = await proc.communicate()
+    return stdout.decode(errors="replace")
+
+def prefetch(path):
+    """Ask the kernel to start reading the file into the page cache before ffmpeg opens it.
+
+    The cached pages outlive our fd, so ffmpeg's own reads hit them. This
+    blocks while the read-ahead is queued, so call it off the event loop.
+    No-op where posix_fadvise isn't available (Windows, macOS).
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+async def inspect_video(infile):
+    """Return ((width, height, pix_fmt), duration) for the first video stream.
+
+    The tuple is None and the duration 0.0 when ffprobe can't tell.
+    """
+    stdout = await run_ffprobe(
+        "-select_streams", "v:0", "-show_entries", "stream=width,height,pix_fmt:format=duration",
+        "-of", "default=nw=1", infile,
+    )
+    fields = dict(line.partition("=")[::2] for line in stdout.splitlines())
+    try:
+        video = int(fields["width"]), int(fields["height"]), fields["pix_fmt"]
+    except (KeyError, ValueError):
+        video = None
+    try:
+        duration = float(fields["duration"])
+    except (KeyError, ValueError):
+        duration = 0.0
+    return video, duration
+
+def software_filter(video):
+    """-vf args for the software path; none at all if the source already is 720p yuv420p."""
+    if video is None:
+        return ["-vf", "scale=1280:720,format=yuv420p"]
+    width, height, pix_fmt = video
+    filters = []
+    if (width, height) != (1280, 720):
+        filters.append("scale=1280:720")
+    # swscale keeps yuv420p sources in yuv420p; only convert when needed
+    if pix_fmt != "yuv420p":
+        filters.append("format=yuv420p")
+    return ["-vf", ",".join(filters)] if filters else []
+
+def build_cmd(infile, outfile, encoder_kind, video=None):
+    # decode, scale and encode all on the same device
+    if encoder_kind == "nvenc":
+        cmd = [
+            "ffmpeg", "-y",
+            "-hwaccel", "cuda",
+            "-hwaccel_output_format", "cuda",
+            "-i", infile,
+            "-map", "0:v:0", "-map", "0:a:0",
+            "-c:v", "h264_nvenc",
+            "-preset", "p4",
+            "-tune", "hq",
+            "-rc", "vbr",
+            "-cq", "23",
+            "-b:v", "0",
+            "-profile:v", "high",
+            "-level:v", "4.0",
+            "-vf", "scale_cuda=1280:720:format=yuv420p",
+        ]
+    elif encoder_kind == "qsv":
+        cmd = [
+            "ffmpeg", "-y",
+            "-hwaccel", "qsv",
+            "-hwaccel_output_format", "qsv",
+            "-i", infile,
+            "-map", "0:v:0", "-map", "0:a:0",
+            "-c:v", "h264_qsv",
+            "-preset", "medium",
+            "-global_quality", "23",
+            "-look_ahead", "1",
+            "-profile:v", "high",
+            "-level:v", "4",  # qsv/vaapi take named integer levels; "4.0" would mean level_idc 4
+            "-vf", "vpp_qsv=w=1280:h=720:format=nv12",
+        ]
+    elif encoder_kind == "vaapi":
+        cmd = [
+            "ffmpeg", "-y",
+            "-hwaccel", "vaapi",
+            "-hwaccel_output_format", "vaapi",
+            "-hwaccel_device", VAAPI_DEVICE,
+            "-i", infile,
+            "-map", "0:v:0", "-map", "0:a:0",
+            "-vf", "format=nv12|vaapi,hwupload,scale_vaapi=1280:720:format=nv12",
+            "-c:v", "h264_vaapi",
+            "-qp", "23",
+            "-profile:v", "high",
+            "-level:v", "4",
+        ]
+    else:
+        cmd = [
+            "ffmpeg", "-y",
+            "-i", infile,
+            "-map", "0:v:0", "-map", "0:a:0",
+            "-c:v", "libx264",
+            "-profile:v", "high",
+            "-level:v", "4.0",
+            "-preset", "medium",
+            "-crf", "20",
+            "-threads", str(THREADS_PER_JOB),
+            "-x264-params", X264_PARAMS,
+            *software_filter(video),
+        ]
+
+    cmd += [
+        "-r", "30000/1001",
+        *AUDIO_ARGS,
+        "-movflags", "+faststart",
+        outfile
+    ]
+    return cmd
+
+async def probe_keyframes(infile):
+    """Return sorted keyframe pts_time values for the first video stream.
+
+    This reads the whole file, so only call it when the file will be segmented.
+    """
+    stdout = await run_ffprobe(
+        "-skip_frame", "nokey", "-select_streams", "v:0",
+        "-show_entries", "frame=pts_time", "-of", "csv=p=0", infile,
+    )
+    try:
+        return sorted(float(t) for t in stdout.split() if t != "N/A")
+    except ValueError:
+        return []
+
+def split_points(duration, keyframes, parts):
+    """Snap evenly spaced split targets to the next keyframe so every segment starts on a GOP."""
+    points = [0.0]
+    for i in range(1, parts):
+        target = duration * i / parts
+        t = next((k for k in keyframes if k >= target), None)
+        if t is not None and t > points[-1] and t < duration:
+            points.append(t)
+    points.append(duration)
+    return points
+
+async def encode_segment(infile, start, end, segfile, video, slots):
     cmd = [
         "ffmpeg", "-y",
+        "-ss", f"{start:.6f}",
         "-i", infile,
-        "-map", "0:v:0", "-map", "0:a:0",
+        "-t", f"{end - start:.6f}",
+        "-map", "0:v:0", "-an",
         "-c:v", "libx264",
         "-profile:v", "high",
         "-level:v", "4.0",
         "-preset", "medium",
         "-crf", "20",
-        "-vf", "scale=1280:720,format=yuv420p",
+        "-threads", str(THREADS_PER_JOB),
+        "-x264-params", X264_PARAMS,
+        "-force_key_frames", "expr:gte(t,n_forced*2)",
+        *software_filter(video),
         "-r", "30000/1001",
-        "-c:a", "aac",
-        "-b:a", "128k",
-        "-ac", "2",
-        "-ar", "32000",
-        "-movflags", "+faststart",
-        outfile
+        segfile
     ]
+    async with slots:
+        await run_ffmpeg(cmd, infile, os.path.splitext(os.path.basename(segfile))[0], check=True)
+
+async def convert_segmented(infile, outfile, video, duration, slots):
+    """Encode one file as GOP-aligned video segments in parallel, then concat.
+
+    Audio is encoded once over the whole file so AAC priming samples don't
+    leave gaps at segment boundaries.
+    """
+    # decide from the cheap duration probe before paying for the keyframe scan
+    if MAX_WORKERS < 2 or duration < 2 * MIN_SEGMENT_SECONDS:
+        return False
+    points = split_points(duration, await probe_keyframes(infile), MAX_WORKERS)
+    if len(points) < 3:
+        return False
+
+    with tempfile.TemporaryDirectory(dir=OUTPUT_DIR) as tmp:
+        # mp4 keeps the encoder's 1001/30000 time base; Matroska would round to 1 ms ticks
+        segfiles = [os.path.join(tmp, f"seg{i:04d}.mp4") for i in range(len(points) - 1)]
+        jobs = [
+            asyncio.ensure_future(encode_segment(infile, start, end, segfile, video, slots))
+            for start, end, segfile in zip(points, points[1:], segfiles)
+        ]
+
+        audiofile = os.path.join(tmp, "audio.m4a")
+        try:
+            await run_ffmpeg(
+                ["ffmpeg", "-y", "-i", infile, "-map", "0:a:0", "-vn", *AUDIO_ARGS, audiofile],
+                infile, "audio", check=True,
+            )
+        finally:
+            # don't let tmp disappear under segments that are still encoding
+            await asyncio.wait(jobs)
+        for job in jobs:
+            job.result()
+
+        listfile = os.path.join(tmp, "list.txt")
+        with open(listfile, "w") as fh:
+            for segfile in segfiles:
+                fh.write(f"file '{os.path.abspath(segfile)}'\n")
+
+        await run_ffmpeg(
+            ["ffmpeg", "-y",
+             "-f", "concat", "-safe", "0", "-i", listfile,
+             "-i", audiofile,
+             "-map", "0:v:0", "-map", "1:a:0",
+             "-c", "copy",
+             "-movflags", "+faststart",
+             outfile],
+            infile, "concat", check=True,
+        )
+    return True
+
+async def convert(infile, outfile, x264_slots):
+    clear_logs(infile)
+    await asyncio.to_thread(prefetch, infile)
+    video = None
+    # software encodes of long files are split across cores; hardware encoders are not
+    if ENCODER == "libx264":
+        # size/pixel format only matter for the software path (hardware filters handle both on-device)
+        video, duration = await inspect_video(infile)
+        try:
+            if await convert_segmented(infile, outfile, video, duration, x264_slots):
+                return infile
+        except subprocess.CalledProcessError:
+            pass  # fall back to a single whole-file encode
+        async with x264_slots:
+            returncode = await run_ffmpeg(build_cmd(infile, outfile, ENCODER, video), infile, "encode")
+    else:
+        returncode = await run_ffmpeg(build_cmd(infile, outfile, ENCODER, video), infile, "encode")
+        if returncode != 0:
+            # e.g. the GPU can't decode this source (10-bit AV1 on older NVDEC); redo it on the CPU
+            video, _ = await inspect_video(infile)
+            async with x264_slots:
+                returncode = await run_ffmpeg(
+                    build_cmd(infile, outfile, "libx264", video), infile, "fallback",
+                )
+    if returncode != 0:
+        return f"{infile} (ffmpeg exited {returncode}, see {LOG_DIR})"
+    return infile
+
+async def run_all(pairs):
+    file_slots = asyncio.Semaphore(MAX_WORKERS)
+    # every libx264 process (segment, whole-file or hardware fallback) takes one of these,
+    # so CPU encodes never exceed the cpu_count // THREADS_PER_JOB sizing
+    x264_slots = asyncio.Semaphore(pick_workers("libx264"))
+
+    async def one(infile, outfile):
+        async with file_slots:
+            print("Finished:", await convert(infile, outfile, x264_slots))
+
+    await asyncio.gather(*(one(infile, outfile) for infile, outfile in pairs))
 
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-    return file
+with os.scandir(INPUT_DIR) as it:
+    files = [e.name for e in it if e.is_file() and e.name.lower().endswith(".mkv")]
 
-files = [f for f in os.listdir(INPUT_DIR) if f.lower().endswith(".mkv")]
+# (infile, outfile) for every input, computed once up front
+pairs = [
+    (os.path.join(INPUT_DIR, f), os.path.join(OUTPUT_DIR, f.rsplit(".", 1)[0] + ".mp4"))
+    for f in files
+]
 
-with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-    futures = [executor.submit(convert, f) for f in files]
-    for f in as_completed(futures):
-        print("Finished:", f.result())
+print("Encoder:", ENCODER, "/", AUDIO_ENCODER)
+asyncio.run(run_all(pairs))
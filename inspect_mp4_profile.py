@@ -22,12 +22,13 @@ Requirements:
  - ffmpeg / ffprobe installed and available in PATH
 """
 
-import json
 import subprocess
 import sys
-from fractions import Fraction
 
+from _probe_cache import cached_probe, json_loads
 
+
+@cached_probe
 def run_ffprobe(path: str) -> dict:
     cmd = [
         "ffprobe",
@@ -37,15 +38,20 @@ def run_ffprobe(path: str) -> dict:
         "-show_streams",
         path,
     ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    # keep stdout as bytes; both parsers accept them directly. stderr is only
+    # useful on failure, so don't pay for a second pipe on every probe
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     if result.returncode != 0:
-        raise RuntimeError(result.stderr)
-    return json.loads(result.stdout)
+        raise RuntimeError(f"ffprobe exited {result.returncode} on {path}")
+    return json_loads(result.stdout)
 
 
 def fps_from_ratio(r: str) -> str:
+    # ffprobe always reports frame rates as "num/den", e.g. "30000/1001"
     try:
-        return f"{float(Fraction(r)):.3f}"
+        num, den = r.split("/", 1)
+        den = int(den)
+        return f"{int(num) / den:.3f}" if den else "unknown"
     except Exception:
         return "unknown"
 
@@ -24,75 +24,101 @@ Usage examples:
 
 Notes:
  - You must have ffmpeg and ffprobe installed and available in PATH.
+ - ffprobe results are cached in ~/.cache/mkv2mp4/probe.db, keyed on path, mtime and size.
+ - Encodes are single-pass CRF. --two-pass (with --video-bitrate) exists for hitting a target
+   size, but it takes twice as long and is not better quality than CRF, especially on short or
+   grainy sources.
  - For stubborn color/brightness issues with HDR or HEVC sources, use --force-yuv420 to add -pix_fmt yuv420p which improves compatibility on many TVs.
 
 """
 
 from __future__ import annotations
 import argparse
-import json
 import os
 import shutil
 import subprocess
 import sys
-from typing import Dict, Optional, Tuple, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Final, Optional, Tuple, List
+
+from _probe_cache import cached_probe
+
+
+# number of ffprobe processes run concurrently during the inspection pass
+PROBE_WORKERS = 8
 
 
 def check_tool(name: str) -> bool:
     return shutil.which(name) is not None
 
 
-def run_ffprobe(file: str) -> Dict:
-    """Run ffprobe and return parsed JSON metadata for the file."""
+@cached_probe
+def run_ffprobe_minimal(file: str, entries: Tuple[str, ...] = ("codec_type", "codec_name")) -> List[Dict[str, str]]:
+    """Run ffprobe asking only for the given stream fields; return one dict per stream.
+
+    Uses ffprobe's compact writer (``key=value|key=value`` per stream) so no
+    JSON has to be produced or parsed.
+    """
     cmd = [
         "ffprobe",
         "-v",
         "error",
-        "-print_format",
-        "json",
-        "-show_streams",
-        "-show_format",
+        "-show_entries",
+        "stream=" + ",".join(entries),
+        "-of",
+        "compact=p=0",
         file,
     ]
-    try:
-        proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return json.loads(proc.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"ffprobe failed: {e}.\nstderr:\n{e.stderr}")
-        raise
+    # stderr is only useful on failure, so don't pay for a second pipe on every probe
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffprobe exited {proc.returncode} on {file}")
+    streams = []
+    for line in proc.stdout.splitlines():
+        if line.strip():
+            streams.append(dict(field.partition("=")[::2] for field in line.strip().split("|")))
+    return streams
 
 
 def get_primary_codecs(file: str) -> Tuple[Optional[str], Optional[str]]:
-    """Return (video_codec, audio_codec) for the first video/audio streams found."""
-    info = run_ffprobe(file)
+    """Return lowercased (video_codec, audio_codec) for the first video/audio streams found."""
     vcodec = None
     acodec = None
-    for s in info.get("streams", []):
+    for s in run_ffprobe_minimal(file):
         if s.get("codec_type") == "video" and vcodec is None:
             vcodec = s.get("codec_name")
         if s.get("codec_type") == "audio" and acodec is None:
             acodec = s.get("codec_name")
         if vcodec and acodec:
             break
-    return vcodec, acodec
+    # normalise once here so the SAFE_* lookups need no per-call lower()
+    return (vcodec.lower() if vcodec else None), (acodec.lower() if acodec else None)
+
+
+def probe_codecs_batch(files: List[str], executor: ThreadPoolExecutor) -> Dict[str, Future]:
+    """Start ffprobe for every file at once and return {file: Future[(vcodec, acodec)]}.
+
+    The probes overlap instead of running one after another, so a batch pays
+    roughly the cost of its slowest ffprobe rather than the sum of all of them.
+    """
+    return {f: executor.submit(get_primary_codecs, f) for f in files}
 
 
 # A conservative set of codecs that are usually safe in MP4 container for most players
-SAFE_VIDEO_CODECS = {"h264", "mpeg4"}  # hevc may be supported but is often problematic on older TVs
-SAFE_AUDIO_CODECS = {"aac", "mp3", "ac3"}  # ac3 in mp4 may not be widely supported on all devices
+SAFE_VIDEO_CODECS: Final[frozenset[str]] = frozenset({"h264", "mpeg4"})  # hevc may be supported but is often problematic on older TVs
+SAFE_AUDIO_CODECS: Final[frozenset[str]] = frozenset({"aac", "mp3", "ac3"})  # ac3 in mp4 may not be widely supported on all devices
 
 
 def is_remux_safe(vcodec: Optional[str], acodec: Optional[str]) -> bool:
     """Decide whether we can simply copy streams into MP4 without re-encoding.
 
     This is a heuristic: if codecs are in SAFE sets then remuxing is attempted.
+    Codec names are expected lowercased, as returned by get_primary_codecs().
     """
     if vcodec is None:
         return False
     # treat hevc (h265) as unsafe by default for broad compatibility
-    low_v = vcodec.lower()
-    low_a = acodec.lower() if acodec else None
-    if low_v in SAFE_VIDEO_CODECS and (low_a is None or low_a in SAFE_AUDIO_CODECS):
+    if vcodec in SAFE_VIDEO_CODECS and (acodec is None or acodec in SAFE_AUDIO_CODECS):
         return True
     return False
 
@@ -107,16 +133,32 @@ def build_ffmpeg_cmd(
     audio_bitrate: str,
     force_yuv420: bool,
     extra_args: Optional[List[str]] = None,
+    pass_num: Optional[int] = None,
+    video_bitrate: Optional[str] = None,
 ) -> List[str]:
+    """Build the ffmpeg command line.
+
+    With ``pass_num`` (1 or 2) the video is encoded as one half of a 2-pass
+    ABR encode at ``video_bitrate`` instead of single-pass CRF. Pass 1 only
+    writes the x264 stats file next to ``outfile``.
+    """
     cmd = ["ffmpeg", "-y", "-i", infile]
 
     if not reencode_video:
         cmd += ["-c:v", "copy"]
     else:
-        cmd += ["-c:v", "libx264", "-preset", preset, "-crf", str(crf)]
+        cmd += ["-c:v", "libx264", "-preset", preset]
+        if pass_num is None:
+            cmd += ["-crf", str(crf)]
+        else:
+            cmd += ["-b:v", video_bitrate, "-pass", str(pass_num), "-passlogfile", outfile + ".2pass"]
         if force_yuv420:
             cmd += ["-pix_fmt", "yuv420p"]
 
+    if pass_num == 1:
+        # first pass only gathers stats: no audio, discard the output
+        return cmd + ["-an", "-f", "mp4", os.devnull]
+
     if not reencode_audio:
         cmd += ["-c:a", "copy"]
     else:
@@ -141,19 +183,37 @@ def convert_file(
     audio_bitrate: str,
     force_yuv420: bool,
     verbose: bool = True,
+    two_pass: bool = False,
+    video_bitrate: Optional[str] = None,
 ) -> None:
     os.makedirs(os.path.dirname(outfile) or ".", exist_ok=True)
-    cmd = build_ffmpeg_cmd(infile, outfile, reencode_video, reencode_audio, crf, preset, audio_bitrate, force_yuv420)
-    if verbose:
-        print("Running ffmpeg:\n", " ".join(cmd))
+    if two_pass and reencode_video:
+        cmds = [
+            build_ffmpeg_cmd(infile, outfile, reencode_video, reencode_audio, crf, preset, audio_bitrate,
+                             force_yuv420, pass_num=n, video_bitrate=video_bitrate)
+            for n in (1, 2)
+        ]
+    else:
+        cmds = [build_ffmpeg_cmd(infile, outfile, reencode_video, reencode_audio, crf, preset, audio_bitrate, force_yuv420)]
     try:
-        # stream ffmpeg output to console so the user can see progress
-        subprocess.run(cmd, check=True)
+        for cmd in cmds:
+            if verbose:
+                print("Running ffmpeg:\n", " ".join(cmd))
+            # stream ffmpeg output to console so the user can see progress
+            subprocess.run(cmd, check=True)
         if verbose:
             print(f"Done: {outfile}")
     except subprocess.CalledProcessError as e:
         print(f"ffmpeg failed on {infile} with return code {e.returncode}")
         raise
+    finally:
+        if len(cmds) > 1:
+            # x264 writes <passlogfile>-0.log and -0.log.mbtree
+            for suffix in ("-0.log", "-0.log.mbtree"):
+                try:
+                    os.remove(outfile + ".2pass" + suffix)
+                except OSError:
+                    pass
 
 
 def safe_output_path(input_path: str, output_dir: str) -> str:
@@ -168,9 +228,11 @@ def find_mkv_files(path: str) -> List[str]:
     if os.path.isfile(path) and path.lower().endswith(".mkv"):
         files.append(path)
     elif os.path.isdir(path):
-        for entry in os.listdir(path):
-            if entry.lower().endswith(".mkv"):
-                files.append(os.path.join(path, entry))
+        # DirEntry carries the file type from the directory listing, so no extra stat per file
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.lower().endswith(".mkv"):
+                    files.append(entry.path)
     return sorted(files)
 
 
@@ -182,6 +244,13 @@ def parse_args() -> argparse.Namespace:
     p.add_argument("--reencode-video", action="store_true", help="Force re-encoding video to h264")
     p.add_argument("--reencode-audio", action="store_true", help="Force re-encoding audio to AAC")
     p.add_argument("--crf", type=int, default=23, help="CRF for x264 (lower = higher quality, default 23)")
+    p.add_argument(
+        "--two-pass",
+        action="store_true",
+        help="Use 2-pass ABR at --video-bitrate instead of CRF (off by default). "
+        "2-pass is generally slower and NOT higher quality than -crf for short/grainy sources; prefer CRF.",
+    )
+    p.add_argument("--video-bitrate", help="Target video bitrate for --two-pass, e.g. 2500k")
     p.add_argument("--preset", default="medium", help="x264 preset (ultrafast, superfast, veryfast, faster, fast, medium, slow, slower, veryslow)")
     p.add_argument("--audio-bitrate", default="160k", help="Audio bitrate for AAC when re-encoding, e.g. 128k, 192k")
     p.add_argument("--force-yuv420", action="store_true", help="Force pixel format to yuv420p (improves compatibility on many TVs)")
@@ -193,6 +262,10 @@ def parse_args() -> argparse.Namespace:
 def main() -> None:
     args = parse_args()
 
+    if args.two_pass and not args.video_bitrate:
+        print("--two-pass requires --video-bitrate (2-pass targets a bitrate, not a CRF).")
+        sys.exit(1)
+
     if not check_tool("ffmpeg"):
         print("Error: ffmpeg is not installed or not found in PATH.\nPlease install ffmpeg and ffprobe and try again.\nExamples:\n  Ubuntu: sudo apt install ffmpeg\n  Mac (Homebrew): brew install ffmpeg\n  Windows: install ffmpeg and add to PATH")
         sys.exit(1)
@@ -210,13 +283,20 @@ def main() -> None:
         if not args.input:
             print("Please specify an input MKV file or use --batch to process a directory.")
             sys.exit(1)
+        if not os.path.isfile(args.input):
+            print(f"Input file not found: {args.input}")
+            sys.exit(1)
         inputs = [args.input]
 
-    for infile in inputs:
-        if not os.path.isfile(infile):
-            print(f"Skipping missing file: {infile}")
-            continue
+    # probe every input in one concurrent pass up front
+    probes: Dict[str, Future] = {}
+    probe_pool = ThreadPoolExecutor(max_workers=PROBE_WORKERS)
+    if not args.no_ffprobe and (not args.reencode_video or not args.reencode_audio):
+        probes = probe_codecs_batch(inputs, probe_pool)
+    probe_pool.shutdown(wait=False)
 
+    # every input was already checked to be a regular file above
+    for infile in inputs:
         outpath = safe_output_path(infile, args.output_dir)
 
         # if user didn't request re-encoding, use ffprobe to inspect
@@ -225,7 +305,7 @@ def main() -> None:
 
         if not args.no_ffprobe and (not reenc_video or not reenc_audio):
             try:
-                vcodec, acodec = get_primary_codecs(infile)
+                vcodec, acodec = probes[infile].result()
                 print(f"Detected codecs for {infile}: video={vcodec} audio={acodec}")
                 if not reenc_video and not is_remux_safe(vcodec, acodec):
                     # Remux is not safe -> recommend re-encoding video/audio
@@ -250,6 +330,8 @@ def main() -> None:
                 preset=args.preset,
                 audio_bitrate=args.audio_bitrate,
                 force_yuv420=args.force_yuv420,
+                two_pass=args.two_pass,
+                video_bitrate=args.video_bitrate,
             )
         except Exception as e:
             print(f"Failed converting {infile}: {e}")